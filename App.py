@@ -1,182 +1,310 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import io
 from datetime import datetime
 from PIL import Image, ImageDraw, ImageFont
 from ebooklib import epub
-import textwrap
+import ijson
+import orjson
+import lxml.etree
+import lxml.html
+import re
+import sys
 
 # --- CONSTANTS & CONFIG ---
 st.set_page_config(page_title="Substack to Kindle", layout="centered")
 
+@st.cache_resource
+def get_session():
+    """Shared HTTP session so the post and comment calls reuse one keep-alive connection."""
+    # cache_resource keeps the pool alive across Streamlit reruns
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=10,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            # Hand the final response back so our own status checks run
+            raise_on_status=False,
+            # A long Retry-After on a 429 would otherwise hold the spinner for minutes
+            respect_retry_after_header=False
+        )
+    ))
+    session.headers.update({"User-Agent": "Mozilla/5.0"})
+    return session
+
+SESSION = get_session()
+REQUEST_TIMEOUT = (3.05, 10) # (connect, read) seconds
+MONTHS = (
+    "January", "February", "March", "April", "May", "June",
+    "July", "August", "September", "October", "November", "December"
+)
+
 # --- LOGIC: SUBSTACK API SCRAPER ---
 
-def extract_slug(url):
-    """Extracts the post slug from a standard Substack URL."""
-    # Example: https://read.substack.com/p/welcome-to-substack -> welcome-to-substack
-    try:
-        if "/p/" in url:
-            return url.split("/p/")[1].split("/")[0].split("?")[0]
-        return None
-    except:
-        return None
+# One pass for scheme, domain and slug; stops the slug at '/', '?' or '#'.
+# Case-insensitive since mobile keyboards often capitalize 'Https://'
+_URL_RE = re.compile(r"https?://(?P<domain>[^/?#]+)/p/(?P<slug>[^/?#]+)", re.IGNORECASE)
+
+def parse_substack_url(url):
+    """Extracts (domain, slug) from a standard Substack URL, or None if it doesn't match."""
+    # Example: https://read.substack.com/p/welcome-to-substack -> ('read.substack.com', 'welcome-to-substack')
+    m = _URL_RE.match(url.strip())
+    return m.group("domain", "slug") if m else None
+
+def format_post_date(date_iso):
+    """Formats an ISO timestamp as e.g. 'March 05, 2024'."""
+    if not date_iso:
+        return "Undated"
+    if sys.version_info < (3, 11):
+        # fromisoformat only accepts a trailing 'Z' from 3.11 on
+        date_iso = date_iso.replace("Z", "+00:00")
+    d = datetime.fromisoformat(date_iso)
+    return f"{MONTHS[d.month - 1]} {d.day:02d}, {d.year}"
+
+def clean_body_html(body_html):
+    """Strips scripts, styles, tracking pixels and inline styles from the post body."""
+    if not body_html or not body_html.strip():
+        return ""
+    root = lxml.html.fragment_fromstring(body_html, create_parent="div")
+    for el in root.xpath("//script | //style | //img[@width='1' or @height='1']"):
+        el.drop_tree() # Keeps the element's tail text
+    for el in root.xpath("//*[@style]"):
+        del el.attrib["style"]
+    return lxml.etree.tostring(root, method="html", encoding="unicode")
+
+def _fetch_post(session, domain, slug):
+    """Fetches the raw post JSON."""
+    api_url = f"https://{domain}/api/v1/posts/{slug}"
+    resp = session.get(api_url, timeout=REQUEST_TIMEOUT)
+    if resp.status_code != 200:
+        # Raised (not returned) so st.cache_data never stores a failed fetch
+        raise RuntimeError(f"API Error: {resp.status_code}")
+    return orjson.loads(resp.content) # Parses the raw bytes; no str decode round trip
+
+def _fetch_comments(session, domain, post_id):
+    """Fetches public comments and formats them as HTML snippets."""
+    comments = []
+    comment_url = f"https://{domain}/api/v1/posts/{post_id}/comments?sort=newest"
+    # Stream the response so long comment threads are parsed one item at a time
+    # instead of materializing the whole JSON document
+    with session.get(comment_url, timeout=REQUEST_TIMEOUT, stream=True) as c_resp:
+        if c_resp.status_code != 200:
+            # Raised (not returned as []) so st.cache_data never stores a failed fetch
+            raise RuntimeError(f"Comments API Error: {c_resp.status_code}")
+        c_resp.raw.decode_content = True # Let urllib3 undo gzip before ijson reads
+        # Extract text from comments
+        for c in ijson.items(c_resp.raw, "comments.item"):
+            # We grab the raw text content if available
+            c_body = c.get("body", "")
+            c_user = c.get("name", "Anonymous")
+            if c_body:
+                comments.append(f"<b>{c_user}:</b> {c_body}")
+    return comments
+
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def fetch_article(domain, slug):
+    """
+    Fetches and parses a post. Cached on (domain, slug) so reruns and URL
+    variants (query strings, trailing slashes) skip the network.
+    """
+    data = _fetch_post(SESSION, domain, slug)
+    return {
+        "post_id": data.get("id"),
+        "title": data.get("title", "Untitled"),
+        "author": data.get("publishedBylines", [{}])[0].get("name", "Unknown Author"),
+        "date": format_post_date(data.get("post_date")),
+        "body": clean_body_html(data.get("body_html", "")),
+        "domain": domain
+    }
+
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def fetch_comments(domain, post_id):
+    """Fetches a post's comments. Cached separately so a failed fetch is retried next time."""
+    return _fetch_comments(SESSION, domain, post_id)
 
 def get_substack_api_data(url):
     """
     Uses Substack's internal API to fetch data without parsing HTML.
     """
-    slug = extract_slug(url)
-    if not slug:
-        return None, "Invalid Substack URL. Must contain '/p/'."
-
-    # Subdomain logic (e.g., 'https://lenny.substack.com' -> 'lenny')
-    try:
-        domain = url.split("//")[1].split("/")[0]
-    except:
-        return None, "Could not parse domain."
+    parsed = parse_substack_url(url)
+    if not parsed:
+        return None, "Invalid Substack URL. Must look like https://<domain>/p/<post>."
+    domain, slug = parsed
 
-    # 1. Get Post Metadata
-    api_url = f"https://{domain}/api/v1/posts/{slug}"
-    headers = {"User-Agent": "Mozilla/5.0"}
-    
     try:
-        resp = requests.get(api_url, headers=headers)
-        if resp.status_code != 200:
-            return None, f"API Error: {resp.status_code}"
-        
-        data = resp.json()
-        post_id = data.get("id")
-        title = data.get("title", "Untitled")
-        author = data.get("publishedBylines", [{}])[0].get("name", "Unknown Author")
-        date_iso = data.get("post_date")
-        date_str = datetime.fromisoformat(date_iso.replace("Z", "+00:00")).strftime("%B %d, %Y") if date_iso else "Undated"
-        body_html = data.get("body_html", "")
-        
-        # 2. Get Comments (Public API)
-        comments = []
-        if post_id:
-            comment_url = f"https://{domain}/api/v1/posts/{post_id}/comments?sort=newest"
-            c_resp = requests.get(comment_url, headers=headers)
-            if c_resp.status_code == 200:
-                c_data = c_resp.json()
-                # Extract text from comments
-                for c in c_data.get("comments", []):
-                    # We grab the raw text content if available
-                    c_body = c.get("body", "")
-                    c_user = c.get("name", "Anonymous")
-                    if c_body:
-                        comments.append(f"<b>{c_user}:</b> {c_body}")
-        
-        return {
-            "title": title,
-            "author": author,
-            "date": date_str,
-            "body": body_html,
-            "comments": comments,
-            "url": url,
-            "domain": domain
-        }, None
-
+        # 1. Get Post Metadata
+        data = fetch_article(domain, slug)
+        data["url"] = url
     except Exception as e:
         return None, str(e)
 
+    # 2. Get Comments (Public API); a failure just means no comments this time
+    try:
+        data["comments"] = fetch_comments(domain, data["post_id"]) if data["post_id"] else []
+    except Exception:
+        data["comments"] = []
+    return data, None
+
 # --- LOGIC: COVER GENERATOR (3 STYLES) ---
 
-def draw_text_wrapped(draw, text, x, y, max_width, font, fill):
-    """Helper to wrap text on image."""
-    lines = textwrap.wrap(text, width=max_width) # approx char width
+TITLE_MAX_WIDTH = 500 # px; keeps titles starting at x=50 inside the frame
+TITLE_MAX_LINES = 5
+COVER_BACKGROUNDS = {
+    "Classic Typography": (248, 241, 229), # Cream
+    "Modern Dark": (20, 20, 20),
+    "Minimalist White": (255, 255, 255)
+}
+
+def _wrap_to_width(text, font, max_width):
+    """Greedy word wrap measured in pixels, so lines fit whatever font is loaded."""
+    lines, line = [], ""
+    for word in text.split():
+        candidate = f"{line} {word}" if line else word
+        if font.getlength(candidate) <= max_width:
+            line = candidate
+            continue
+        if line:
+            lines.append(line)
+        # A single word wider than the line is broken by characters
+        while len(word) > 1 and font.getlength(word) > max_width:
+            cut = len(word) - 1
+            while cut > 1 and font.getlength(word[:cut]) > max_width:
+                cut -= 1
+            lines.append(word[:cut])
+            word = word[cut:]
+        line = word
+    if line:
+        lines.append(line)
+    return lines
+
+def draw_text_wrapped(draw, text, x, y, max_width, font, fill, max_lines=None):
+    """Helper to wrap text on image. Returns the y just below the last line."""
+    lines = _wrap_to_width(text, font, max_width)
+    if max_lines and len(lines) > max_lines:
+        # Truncate with an ellipsis that still fits the line
+        last = lines[max_lines - 1]
+        while last and font.getlength(last + "...") > max_width:
+            last = last[:-1]
+        lines = lines[:max_lines - 1] + [last.rstrip() + "..."]
+    # Line height from the font's glyph extent plus ~25% leading
+    glyph_bottom = font.getbbox("Ag")[3]
+    line_height = glyph_bottom + glyph_bottom // 4
     current_y = y
     for line in lines:
         draw.text((x, current_y), line, font=font, fill=fill)
-        current_y += 40 # Line height
+        current_y += line_height
     return current_y
 
-def generate_cover(style, data):
-    width, height = 600, 900
-    img = Image.new('RGB', (width, height), color=(255, 255, 255))
-    d = ImageDraw.Draw(img)
-    
+@st.cache_resource
+def load_fonts():
+    """Loads the (large, small) cover fonts once per process."""
     # Load Font (Fallback to default if custom not found)
     try:
         # In Streamlit Cloud, usually DejavuSans is available or we use default
-        # For better results in cloud, we use large default size or upload a ttf
-        font_large = ImageFont.load_default() 
-        font_small = ImageFont.load_default()
-    except:
-        font_large = ImageFont.load_default()
-        font_small = ImageFont.load_default()
+        return ImageFont.truetype("DejaVuSans.ttf", 32), ImageFont.truetype("DejaVuSans.ttf", 18)
+    except OSError:
+        # Pillow's bundled scalable default font (Pillow >= 10.1)
+        return ImageFont.load_default(size=32), ImageFont.load_default(size=18)
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def _render_cover(style, title, author, date, domain, preview=False):
+    """Renders a cover to JPEG bytes (small PNG when preview). Cached so re-selecting a style or refetching an article skips the redraw."""
+    width, height = 600, 900
+    # Allocate the canvas once, already filled with the style's background
+    img = Image.new('RGB', (width, height), color=COVER_BACKGROUNDS.get(style, (255, 255, 255)))
+    d = ImageDraw.Draw(img)
+    font_large, font_small = load_fonts()
 
     if style == "Classic Typography":
         # Cream background, dark text, centered
-        img = Image.new('RGB', (width, height), color=(248, 241, 229))
-        d = ImageDraw.Draw(img)
         d.rectangle([20, 20, width-20, height-20], outline=(0,0,0), width=3)
         
         # Title
-        d.text((50, 200), data['title'], fill="black", font=font_large)
-        d.text((50, 400), data['author'], fill="black", font=font_small)
-        d.text((50, 450), data['date'], fill="gray", font=font_small)
+        title_end = draw_text_wrapped(d, title, 50, 200, TITLE_MAX_WIDTH, font_large, "black", TITLE_MAX_LINES)
+        # Short titles keep the original layout; long ones push the byline down
+        author_y = max(400, title_end + 20)
+        d.text((50, author_y), author, fill="black", font=font_small)
+        d.text((50, author_y + 50), date, fill="gray", font=font_small)
         d.text((50, height-100), "SUBSTACK ARCHIVE", fill="gray", font=font_small)
 
     elif style == "Modern Dark":
         # Black background, White text, Bold accent
-        img = Image.new('RGB', (width, height), color=(20, 20, 20))
-        d = ImageDraw.Draw(img)
-        
         # Accent Line
         d.rectangle([0, 150, 20, 150 + 200], fill=(255, 87, 34)) # Orange strip
         
-        d.text((50, 150), data['title'], fill="white", font=font_large)
-        d.text((50, 500), f"Written by {data['author']}", fill="lightgray", font=font_small)
-        d.text((50, 530), data['date'], fill="gray", font=font_small)
+        title_end = draw_text_wrapped(d, title, 50, 150, TITLE_MAX_WIDTH, font_large, "white", TITLE_MAX_LINES)
+        author_y = max(500, title_end + 20)
+        d.text((50, author_y), f"Written by {author}", fill="lightgray", font=font_small)
+        d.text((50, author_y + 30), date, fill="gray", font=font_small)
 
     elif style == "Minimalist White":
         # Pure white, very clean, bottom aligned
-        img = Image.new('RGB', (width, height), color=(255, 255, 255))
-        d = ImageDraw.Draw(img)
-        
         d.text((50, 50), "ARTICLE", fill="red", font=font_small)
-        d.text((50, 100), data['title'], fill="black", font=font_large)
-        d.line((50, 300, 550, 300), fill="black", width=2)
-        d.text((50, 320), data['author'].upper(), fill="black", font=font_small)
-        d.text((50, height-50), data['domain'], fill="gray", font=font_small)
+        title_end = draw_text_wrapped(d, title, 50, 100, TITLE_MAX_WIDTH, font_large, "black", TITLE_MAX_LINES)
+        rule_y = max(300, title_end + 10)
+        d.line((50, rule_y, 550, rule_y), fill="black", width=2)
+        d.text((50, rule_y + 20), author.upper(), fill="black", font=font_small)
+        d.text((50, height-50), domain, fill="gray", font=font_small)
 
     # Convert to bytes
     img_buffer = io.BytesIO()
-    img.save(img_buffer, format="JPEG")
+    if preview:
+        # Column-width thumbnail; a fast PNG is cheaper than a full-size JPEG encode
+        img.thumbnail((200, 300), Image.Resampling.LANCZOS)
+        img.save(img_buffer, format="PNG", optimize=False, compress_level=1)
+    else:
+        # Single-pass baseline encode with 4:2:0 chroma subsampling
+        img.save(img_buffer, format="JPEG", quality=85, optimize=False, progressive=False, subsampling=2)
     return img_buffer.getvalue()
 
+def generate_cover(style, data, preview=False):
+    """Builds the cover for a fetched article (hashable scalars only reach the cache)."""
+    return _render_cover(style, data['title'], data['author'], data['date'], data['domain'], preview)
+
 # --- LOGIC: EPUB CREATION ---
 
-def create_epub(data, cover_bytes):
+@st.cache_resource(max_entries=8, show_spinner=False)
+def _build_epub(url, cover_bytes, title, author, date, body, comments):
+    """Serializes the EPUB to bytes. Cached so unrelated reruns skip the zip write."""
+    # cache_resource hands back the same immutable bytes object on each hit;
+    # cache_data would unpickle a fresh full copy of the book every rerun
     book = epub.EpubBook()
-    book.set_identifier(data['url'])
-    book.set_title(data['title'])
+    book.set_identifier(url)
+    book.set_title(title)
     book.set_language('en')
-    book.add_author(data['author'])
+    book.add_author(author)
     
     book.set_cover("cover.jpg", cover_bytes)
     
     # Intro Chapter
     intro_html = f"""
-    <h1>{data['title']}</h1>
-    <h3>{data['author']}</h3>
-    <p><i>{data['date']}</i></p>
-    <p>Source: <a href="{data['url']}">{data['url']}</a></p>
+    <h1>{title}</h1>
+    <h3>{author}</h3>
+    <p><i>{date}</i></p>
+    <p>Source: <a href="{url}">{url}</a></p>
     <hr/>
     """
     
-    # Combine body
-    final_html = intro_html + data['body']
+    # Combine body (collect parts and join once instead of repeated +=)
+    parts = [intro_html, body]
     
     # Add Comments Chapter if exists
-    if data['comments']:
-        final_html += "<hr/><h1>Comments</h1>"
-        for c in data['comments']:
-            final_html += f"<div style='margin-bottom:15px; border-left:2px solid #ccc; padding-left:10px;'>{c}</div>"
+    if comments:
+        parts.append("<hr/><h1>Comments</h1>")
+        parts.extend(
+            f"<div style='margin-bottom:15px; border-left:2px solid #ccc; padding-left:10px;'>{c}</div>"
+            for c in comments
+        )
+    final_html = "".join(parts)
 
     c1 = epub.EpubHtml(title='Article', file_name='article.xhtml', lang='en')
-    c1.content = final_html
+    # ebooklib parses content with a UTF-8 lxml parser; hand it bytes encoded once
+    c1.content = final_html.encode("utf-8")
     book.add_item(c1)
     
     book.toc = (c1,)
@@ -185,8 +313,16 @@ def create_epub(data, cover_bytes):
     book.add_item(epub.EpubNav())
 
     buffer = io.BytesIO()
-    epub.write_epub(buffer, book, {})
-    return buffer
+    # Level 1 DEFLATE: HTML compresses nearly as well as the default 6, ~3x faster
+    epub.write_epub(buffer, book, {"compresslevel": 1})
+    return buffer.getvalue()
+
+def create_epub(data, cover_bytes):
+    """Builds the EPUB for a fetched article; comments become a tuple so they hash."""
+    return _build_epub(
+        data['url'], cover_bytes, data['title'], data['author'],
+        data['date'], data['body'], tuple(data['comments'])
+    )
 
 # --- UI: MAIN INTERFACE ---
 
@@ -204,6 +340,7 @@ if url_input:
                 st.error(error)
             else:
                 st.session_state['data'] = data
+                st.session_state.pop('covers', None) # New article: thumbnails must be redrawn
                 st.success("Article & Comments Found!")
 
 if 'data' in st.session_state:
@@ -212,29 +349,33 @@ if 'data' in st.session_state:
     st.divider()
     st.subheader("Select a Cover Style")
     
-    # Generate 3 options
+    # Render the 3 preview thumbnails once per fetched article; the full-size JPEG
+    # is only rendered for the style the user selects
+    if 'covers' not in st.session_state:
+        st.session_state['covers'] = {
+            style: generate_cover(style, data, preview=True)
+            for style in ("Classic Typography", "Modern Dark", "Minimalist White")
+        }
+    covers = st.session_state['covers']
     col1, col2, col3 = st.columns(3)
     
     with col1:
         st.caption("Classic")
-        cov1 = generate_cover("Classic Typography", data)
-        st.image(cov1)
+        st.image(covers["Classic Typography"])
         if st.button("Select Classic", key="btn1"):
-            st.session_state['selected_cover'] = cov1
+            st.session_state['selected_cover'] = generate_cover("Classic Typography", data)
             
     with col2:
         st.caption("Dark")
-        cov2 = generate_cover("Modern Dark", data)
-        st.image(cov2)
+        st.image(covers["Modern Dark"])
         if st.button("Select Dark", key="btn2"):
-            st.session_state['selected_cover'] = cov2
+            st.session_state['selected_cover'] = generate_cover("Modern Dark", data)
             
     with col3:
         st.caption("Minimal")
-        cov3 = generate_cover("Minimalist White", data)
-        st.image(cov3)
+        st.image(covers["Minimalist White"])
         if st.button("Select Minimal", key="btn3"):
-            st.session_state['selected_cover'] = cov3
+            st.session_state['selected_cover'] = generate_cover("Minimalist White", data)
 
     if 'selected_cover' in st.session_state:
         st.divider()
@@ -245,7 +386,7 @@ if 'data' in st.session_state:
         
         st.download_button(
             label="Download EPUB for Kindle",
-            data=epub_file.getvalue(),
+            data=epub_file,
             file_name=f"{data['title'][:15]}_Kindle.epub",
             mime="application/epub+zip"
         )